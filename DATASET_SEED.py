@@ -2,32 +2,200 @@
 # -*- coding: utf-8 -*-
 
 import kagglehub
+import os
 from pathlib import Path
-from PIL import Image
-import base64
+from PIL import Image, ImageOps, UnidentifiedImageError
+from io import BytesIO
 import torch
-import csv
-import json
+import numpy as np
 import pandas as pd
-import sys
+import pyarrow as pa
+import pyarrow.parquet as pq
+from torch.utils.data import Dataset, DataLoader
 
 # For Jina CLIP
 from transformers.models.auto.processing_auto import AutoProcessor
 from transformers.models.auto.modeling_auto import AutoModel
 
+# Default batch size; on CUDA find_max_batch_size() probes for the largest
+# batch that fits in GPU memory instead
+BATCH_SIZE = 64
+MAX_BATCH_SIZE = 1024
+# Host memory allowed for batches queued by DataLoader workers (pinned on
+# CUDA); a 1024-image float32 batch alone is ~616 MB
+LOADER_MEMORY_BUDGET = 2 * 1024 ** 3
+MAX_LOADER_WORKERS = 8
+EMBEDDING_DIM = 768
+# Jina CLIP vectors are L2-normalized, so FP16 keeps cosine similarity
+# within noise while halving the embedding column
+EMBEDDING_DTYPE = np.float16
+
+# Label columns carried over from labels_utf8.csv, in output order
+LABEL_COLUMNS = ["Sex", "Height", "Weight", "Hair", "Eyes", "Race", "Sex Offender", "Offense"]
+# Low-cardinality labels are stored as categoricals (dictionary-encoded),
+# numeric-looking ones as float32 when every value parses
+CATEGORICAL_LABELS = ["Sex", "Hair", "Eyes", "Race", "Sex Offender"]
+NUMERIC_LABELS = ["Height", "Weight"]
+
+# Set SEED_USE_ONNX=1 to run the vision tower through ONNX Runtime
+# (TensorRT FP16 when available, CUDA otherwise) instead of PyTorch eager.
+# Needs onnxruntime-gpu: pip install -r requirements-offline.txt
+USE_ONNX = os.environ.get("SEED_USE_ONNX") == "1"
+ONNX_PATH = "jina_clip_vision.onnx"
+
+# Images are stored pre-resized to the model's input resolution, so
+# neither the processor here nor the API has to resize them again
+IMAGE_SIZE = (224, 224)
+
+
+class MugshotDS(Dataset):
+    """
+    Decodes each mugshot once, resizes it to IMAGE_SIZE and runs the CLIP
+    processor inside the DataLoader workers, so the GPU only ever sees
+    stacked batches. Returns the re-encoded 224x224 JPEG alongside the
+    pixel values. Files that are not valid images come back as None and
+    are dropped by collate_mugshots.
+    """
+
+    def __init__(self, paths, processor):
+        self.paths = paths
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        file_path = self.paths[idx]
+        try:
+            image = Image.open(BytesIO(file_path.read_bytes()))
+            # Let libjpeg downscale while decoding, then resize exactly once.
+            # Center-crop to square rather than stretching, with the same
+            # bicubic fit as facecrime_embeddings_generator.py so both
+            # pipelines store identical images and embeddings
+            image.draft("RGB", IMAGE_SIZE)
+            image = ImageOps.fit(image.convert("RGB"), IMAGE_SIZE, Image.Resampling.BICUBIC)
+        except (UnidentifiedImageError, OSError):
+            return None
+        try:
+            buffered = BytesIO()
+            image.save(buffered, format="JPEG", quality=90)
+            inputs = self.processor(images=image, return_tensors="pt")
+        except Exception as e:
+            print(f"[Embedding Error] {file_path.name}: {e}")
+            return None
+        return inputs['pixel_values'][0], file_path.name, buffered.getvalue()
+
+
+def collate_mugshots(batch):
+    batch = [item for item in batch if item is not None]
+    if not batch:
+        return None
+    pixel_values, names, raws = zip(*batch)
+    return torch.stack(pixel_values), list(names), list(raws)
+
+
+class VisionTower(torch.nn.Module):
+    """Thin wrapper so torch.onnx.export traces get_image_features."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+def load_onnx_session(model, device, onnx_path=ONNX_PATH):
+    """
+    Export the FP32 vision tower to ONNX once, then open an ONNX Runtime
+    session over it. The same file can be turned into a standalone engine
+    with `trtexec --fp16 --onnx=jina_clip_vision.onnx`.
+    """
+    import onnxruntime as ort
+
+    if not Path(onnx_path).exists():
+        print(f"Exporting vision tower to {onnx_path} ...")
+        dummy_pixel_values = torch.zeros(1, 3, 224, 224, device=device)
+        torch.onnx.export(
+            VisionTower(model),
+            dummy_pixel_values,
+            onnx_path,
+            opset_version=17,
+            input_names=["pixel_values"],
+            output_names=["embeds"],
+            dynamic_axes={"pixel_values": {0: "B"}, "embeds": {0: "B"}}
+        )
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = [
+        ("TensorrtExecutionProvider", {"trt_fp16_enable": True}),
+        "CUDAExecutionProvider",
+        "CPUExecutionProvider"
+    ]
+    available = set(ort.get_available_providers())
+    providers = [p for p in providers if (p[0] if isinstance(p, tuple) else p) in available]
+    return ort.InferenceSession(onnx_path, sess_options=sess_options, providers=providers)
+
+
+def find_max_batch_size(model, device, start=8, limit=MAX_BATCH_SIZE):
+    """
+    Double the batch size from `start` until the vision forward runs out
+    of GPU memory or would exceed `limit`, and return the largest size
+    that actually ran. If `start` itself doesn't fit, halve it until one
+    does (1 at the very least).
+    """
+    def fits(batch_size):
+        try:
+            dummy = torch.zeros(batch_size, 3, *IMAGE_SIZE, device=device, dtype=model.dtype)
+            model.get_image_features(pixel_values=dummy)
+            torch.cuda.synchronize()
+            return True
+        except torch.cuda.OutOfMemoryError:
+            return False
+        finally:
+            torch.cuda.empty_cache()
+
+    with torch.inference_mode():
+        largest = 0
+        batch_size = start
+        while batch_size <= limit and fits(batch_size):
+            largest = batch_size
+            batch_size *= 2
+        if not largest:
+            batch_size = start // 2
+            while batch_size > 1 and not fits(batch_size):
+                batch_size //= 2
+            largest = max(batch_size, 1)
+    return largest
+
+
+def loader_settings(batch_size):
+    """
+    DataLoader (num_workers, prefetch_factor) for `batch_size`. Every
+    worker keeps prefetch_factor float32 batches in flight, pinned on
+    CUDA, so both are sized to keep that under LOADER_MEMORY_BUDGET
+    (at least one batch per worker, no more than PyTorch's default of 2).
+    """
+    batch_bytes = batch_size * 3 * IMAGE_SIZE[0] * IMAGE_SIZE[1] * 4
+    budget_batches = max(1, LOADER_MEMORY_BUDGET // batch_bytes)
+    num_workers = min(os.cpu_count() or 0, MAX_LOADER_WORKERS, budget_batches)
+    if num_workers == 0:
+        return 0, None
+    return num_workers, min(2, max(1, budget_batches // num_workers))
+
+
 def main():
     # ---------------------------------------------------------------------
     # Step 0: Basic settings
     # ---------------------------------------------------------------------
-    # Output CSV file with row_id etc.
-    final_csv_file = "facecrime_merged_embeddings_fixed_with_id.csv"
+    # Output Parquet file with row_id etc., plus a directory of raw images
+    final_parquet_file = "facecrime.parquet"
+    images_dir = Path("images")
 
     # Path to labels file
     labels_csv_file = "labels_utf8.csv"
 
-    # We'll store embeddings in memory as a list of dicts
-    embeddings_data = []
-
     # ---------------------------------------------------------------------
     # Step 1: Download dataset from KaggleHub
     # ---------------------------------------------------------------------
@@ -45,125 +213,128 @@ def main():
     model = AutoModel.from_pretrained('jinaai/jina-clip-v1', trust_remote_code=True).to(device)
     model.eval()
 
+    # Either hand the vision tower to ONNX Runtime, or on GPU run it in half
+    # precision and let torch.compile fuse the LayerNorm/GELU chains.
+    # mode="reduce-overhead" captures the forward as a CUDA graph, which
+    # is only replayed (not re-recorded) while the batch shape stays the
+    # same, so partial batches are padded up to batch_size below.
+    # CPU stays in FP32.
+    ort_sess = None
+    static_batch = False
+    batch_size = BATCH_SIZE
+    if USE_ONNX:
+        ort_sess = load_onnx_session(model, device)
+    elif device.type == "cuda":
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        model = model.to(device=device, dtype=dtype)
+        # Probe in eager mode, before compiling for one fixed shape
+        batch_size = find_max_batch_size(model, device)
+        print(f"Using batch size {batch_size}")
+        model.get_image_features = torch.compile(
+            model.get_image_features, mode="reduce-overhead", fullgraph=False
+        )
+        static_batch = True
+
     # ---------------------------------------------------------------------
-    # Step 3: Helper functions
+    # Step 3: Load labels (small) up front so rows can be streamed out
     # ---------------------------------------------------------------------
-    def load_image_base64(file_path):
-        try:
-            with open(file_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
-        except Exception as e:
-            print(f"[Base64 Error] {file_path.name}: {e}")
-            return None
+    print(f"Reading labels from: {labels_csv_file}")
+    labels_df = pd.read_csv(labels_csv_file)
 
-    def get_embeddings(file_path):
-        try:
-            image = Image.open(file_path).convert("RGB")
-            inputs = processor(images=image, return_tensors="pt")
-            pixel_values = inputs['pixel_values'].to(device)
-            with torch.no_grad():
-                emb = model.get_image_features(pixel_values=pixel_values)
-            emb = emb.squeeze().cpu().numpy().tolist()  # convert to list of floats
-            return emb
-        except Exception as e:
-            print(f"[Embedding Error] {file_path.name}: {e}")
-            return None
+    # Some label columns might be missing => fill them with empty strings
+    for col in LABEL_COLUMNS:
+        if col not in labels_df.columns:
+            labels_df[col] = ""
+    labels_df = labels_df[["ID"] + LABEL_COLUMNS].drop_duplicates("ID")
 
-    # ---------------------------------------------------------------------
-    # Step 4: Iterate over images, compute embeddings + base64
-    # ---------------------------------------------------------------------
-    print("Generating embeddings in memory (no partial CSV) ...")
-    for file_path in folder_path.rglob("*"):
-        if not file_path.is_file():
+    label_types = {}
+    for col in LABEL_COLUMNS:
+        if col in CATEGORICAL_LABELS:
+            labels_df[col] = labels_df[col].fillna("").astype(str).astype("category")
+            label_types[col] = pa.dictionary(pa.int32(), pa.string())
             continue
-        # Check if it's a valid image
-        try:
-            Image.open(file_path).convert("RGB")
-        except:
-            continue
-
-        image_b64 = load_image_base64(file_path)
-        embedding_list = get_embeddings(file_path)
-        if image_b64 and embedding_list:
-            # We'll store the embedding as a JSON string, so it's easy to keep in CSV
-            embeddings_data.append({
-                "filename": file_path.name,
-                "image_base64": image_b64,
-                "embedding": json.dumps(embedding_list)
-            })
+        if col in NUMERIC_LABELS:
+            numeric = pd.to_numeric(labels_df[col], errors="coerce")
+            if numeric.notna().sum() == labels_df[col].notna().sum():
+                labels_df[col] = numeric.astype("float32")
+                label_types[col] = pa.float32()
+                continue
+        labels_df[col] = labels_df[col].astype("string")
+        label_types[col] = pa.string()
 
-    print(f"Found {len(embeddings_data)} valid images with embeddings.")
+    # filename -> label values, looked up per streamed row
+    labels_idx = {row[0]: row[1:] for row in labels_df.itertuples(index=False, name=None)}
+    missing_labels = (None,) * len(LABEL_COLUMNS)
 
-    # Convert to a DataFrame
-    embeddings_df = pd.DataFrame(embeddings_data)
+    # Our final columns:
+    # row_id, filename, image_path,
+    # Sex, Height, Weight, Hair, Eyes, Race, Sex Offender, Offense, embedding
+    schema = pa.schema(
+        [("row_id", pa.int64()), ("filename", pa.string()), ("image_path", pa.string())]
+        + [(col, label_types[col]) for col in LABEL_COLUMNS]
+        + [("embedding", pa.list_(pa.from_numpy_dtype(EMBEDDING_DTYPE), EMBEDDING_DIM))]
+    )
 
     # ---------------------------------------------------------------------
-    # Step 5: Merge with labels
+    # Step 4: Build a batched loader over the dataset
     # ---------------------------------------------------------------------
-    print(f"Reading labels from: {labels_csv_file}")
-    labels_df = pd.read_csv(labels_csv_file)
-
-    print("Merging on filename == ID ...")
-    merged_df = pd.merge(
-        embeddings_df,
-        labels_df,
-        how="left",
-        left_on="filename",
-        right_on="ID"
+    paths = [p for p in folder_path.rglob("*") if p.is_file()]
+    num_workers, prefetch_factor = loader_settings(batch_size)
+    loader = DataLoader(
+        MugshotDS(paths, processor),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_mugshots
     )
 
     # ---------------------------------------------------------------------
-    # Step 6: Select + reorder columns
+    # Step 5: Embed each batch, write its images, append it to the Parquet
     # ---------------------------------------------------------------------
-    # Our final columns:
-    # row_id, filename, image_base64, embedding,
-    # Sex, Height, Weight, Hair, Eyes, Race, Sex Offender, Offense
-    final_columns = [
-        "filename",
-        "image_base64",
-        "embedding",
-        "Sex",
-        "Height",
-        "Weight",
-        "Hair",
-        "Eyes",
-        "Race",
-        "Sex Offender",
-        "Offense"
-    ]
+    print(f"Writing images to {images_dir}/ and rows to {final_parquet_file} ...")
+    images_dir.mkdir(parents=True, exist_ok=True)
+    row_count = 0
 
-    # Drop the 'ID' column if it exists, we only need 'filename'
-    if "ID" in merged_df.columns:
-        merged_df.drop(columns=["ID"], inplace=True)
+    with pq.ParquetWriter(final_parquet_file, schema, compression="zstd") as writer, torch.inference_mode():
+        for batch in loader:
+            if batch is None:
+                continue
+            pixel_values, names, raws = batch
+            if ort_sess is not None:
+                emb = ort_sess.run(None, {"pixel_values": pixel_values.numpy()})[0].astype(EMBEDDING_DTYPE)
+            else:
+                n = pixel_values.shape[0]
+                if static_batch and n < batch_size:
+                    padding = pixel_values.new_zeros((batch_size - n, *pixel_values.shape[1:]))
+                    pixel_values = torch.cat([pixel_values, padding])
+                pixel_values = pixel_values.to(device, dtype=model.dtype, non_blocking=True)
+                emb = model.get_image_features(pixel_values=pixel_values)
+                emb = emb[:n].to(torch.float16).cpu().numpy()
 
-    # Some rows might have no labels => fill them with default empty strings
-    for col in ["Sex","Height","Weight","Hair","Eyes","Race","Sex Offender","Offense"]:
-        if col not in merged_df.columns:
-            merged_df[col] = ""
+            row_ids = list(range(row_count + 1, row_count + len(names) + 1))
+            row_count += len(names)
 
-    # If the columns appear in different names or orders, handle them carefully
-    # We'll fill missing columns with an empty string, if needed
-    for col in final_columns:
-        if col not in merged_df.columns:
-            merged_df[col] = ""
+            # Pre-resized JPEGs go to disk, referenced by path
+            image_paths = []
+            for row_id, jpeg_bytes in zip(row_ids, raws):
+                image_path = images_dir / f"{row_id}.jpg"
+                image_path.write_bytes(jpeg_bytes)
+                image_paths.append(str(image_path))
 
-    # Reorder
-    final_df = merged_df[final_columns].copy()
+            # Left-join with labels on filename == ID
+            batch_labels = [labels_idx.get(filename, missing_labels) for filename in names]
 
-    # ---------------------------------------------------------------------
-    # Step 7: Add row_id
-    # ---------------------------------------------------------------------
-    final_df.insert(0, "row_id", final_df.index + 1)
-
-    # ---------------------------------------------------------------------
-    # Step 8: Write final CSV
-    # ---------------------------------------------------------------------
-    print(f"Writing final CSV: {final_csv_file}")
-    # Ensuring we can handle large fields
-    csv.field_size_limit(sys.maxsize)
+            columns = {"row_id": row_ids, "filename": names, "image_path": image_paths}
+            for col, values in zip(LABEL_COLUMNS, zip(*batch_labels)):
+                columns[col] = pa.array(values, type=label_types[col], from_pandas=True)
+            columns["embedding"] = pa.FixedSizeListArray.from_arrays(
+                pa.array(np.ascontiguousarray(emb, dtype=EMBEDDING_DTYPE).ravel()), EMBEDDING_DIM
+            )
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
 
-    final_df.to_csv(final_csv_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
-    print(f"✅ Done! Created {final_csv_file} with row_id and all columns.")
+    print(f"Found {row_count} valid images with embeddings.")
+    print(f"✅ Done! Created {final_parquet_file} with row_id and all columns.")
 
 
 if __name__ == "__main__":
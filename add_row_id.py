@@ -1,32 +1,48 @@
 #!/usr/bin/env python3
-import sys
-import csv
+import os
 
 INPUT_CSV = "/tmp/facecrime_merged_embeddings_fixed.csv"
 OUTPUT_CSV = "/tmp/facecrime_merged_embeddings_fixed_with_id.csv"
 
-csv.field_size_limit(sys.maxsize)
+# 1 MiB buffers; the rows carry multi-KB base64/embedding fields
+BUFFER_SIZE = 1 << 20
 
 def main():
-    with open(INPUT_CSV, "r", newline="", encoding="utf-8") as f_in, \
-         open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f_out:
-
-        reader = csv.DictReader(f_in)
-        # Prepend a new column name 'row_id' to the existing fieldnames
-        fieldnames = ["row_id"] + reader.fieldnames
-        
-        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-        writer.writeheader()
-
-        row_id_counter = 1
-        for row in reader:
-            # Insert the new 'row_id' key-value before writing
-            row["row_id"] = row_id_counter
-            writer.writerow(row)
-            row_id_counter += 1
+    # The only change is a new leading column, so work on raw lines and
+    # never parse or re-escape the (huge) fields. That requires every
+    # record to be exactly one line: a quoted field containing a newline
+    # (e.g. a multi-line Offense) leaves an odd number of '"' on the line
+    # (escaped quotes come in pairs), and would get a row_id spliced into
+    # its middle, so stop rather than write a corrupt CSV.
+    # Output goes to a temp file that only replaces OUTPUT_CSV once every
+    # row is written, so a failed run never leaves a truncated CSV behind.
+    tmp_path = OUTPUT_CSV + ".tmp"
+    try:
+        with open(INPUT_CSV, "rb", buffering=BUFFER_SIZE) as f_in, \
+             open(tmp_path, "wb", buffering=BUFFER_SIZE) as f_out:
+
+            # Prepend a new column name 'row_id' to the existing header
+            header = f_in.readline()
+            f_out.write(b"row_id," + header)
+
+            row_id = 0
+            for line in f_in:
+                # Blank lines (e.g. a trailing newline) are not records
+                if not line.strip():
+                    continue
+                row_id += 1
+                if line.count(b'"') % 2:
+                    raise ValueError(
+                        f"Record {row_id} has a quoted field spanning lines; "
+                        "add the row_id with the csv module instead"
+                    )
+                f_out.write(b"%d," % row_id + line)
+        os.replace(tmp_path, OUTPUT_CSV)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
     print(f"✅ Done. New CSV with 'row_id' created at: {OUTPUT_CSV}")
 
 if __name__ == "__main__":
     main()
-
@@ -1,12 +1,20 @@
 # api/embedding.py
 
-import base64
-import requests
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
+import orjson
+import pybase64
 from PIL import Image
 from io import BytesIO
 from typing import Union, List
 import os 
 import logging
+import re
 
 # Initialize the logger
 logger = logging.getLogger(__name__)
@@ -27,94 +35,368 @@ IMAGE_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
 }
 
-# Resize image to 224x224 using Lanczos filter
+# "data:image/<type>[;param=value...];base64," prefix on data URLs
+_DATA_URL_RE = re.compile(r"^data:image/[^;,]+(?:;[^;,]*)*;base64,")
+
+# Leading base64 characters of JPEG, PNG, GIF and WEBP files
+IMAGE_MAGIC_B64 = ("/9j/", "iVBORw", "R0lGOD", "UklGR")
+
+# Shared client so connections to api.jina.ai and image hosts are kept
+# alive across requests instead of paying TCP + TLS setup on every call.
+# Idle connections are held for 30s; calls without their own timeout get
+# 10s to connect and 30s for each read/write/pool wait. These are per-phase
+# limits, not a deadline for the whole request.
+_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30),
+    timeout=httpx.Timeout(30.0, connect=10.0)
+)
+
+async def close_http_client():
+    await _client.aclose()
+
+# Per-thread JPEG output buffer, rewound and reused on each resize
+# instead of allocating a new BytesIO per image; getvalue() copies out,
+# so reuse is safe
+_tls = threading.local()
+
+def _output_buffer() -> BytesIO:
+    buffered = getattr(_tls, "buffered", None)
+    if buffered is None:
+        buffered = _tls.buffered = BytesIO()
+    buffered.seek(0)
+    buffered.truncate()
+    return buffered
+
+# Resize image to 224x224. draft() lets libjpeg downscale while decoding,
+# and bilinear is plenty for the model's input resolution. For formats
+# draft() can't help with (PNG, WEBP, ...), reducing_gap first shrinks by
+# an integer factor with a cheap box reduce, so the bilinear pass only
+# covers the last <2x.
 def resize_image(image_data: bytes) -> str:
+    # Image.open only parses the header; nothing is decoded yet
     image = Image.open(BytesIO(image_data))
-    image = image.resize((224, 224), Image.Resampling.LANCZOS)
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    # Already an RGB JPEG at or below model resolution (e.g. pre-resized
+    # seed images or frontend thumbnails): skip the decode/re-encode round
+    # trip. CMYK / grayscale JPEGs still go through convert("RGB") below.
+    if (
+        image.format == "JPEG"
+        and image.mode == "RGB"
+        and image.width <= 224
+        and image.height <= 224
+    ):
+        return pybase64.b64encode(image_data).decode('ascii')
+    image.draft('RGB', (224, 224))
+    image = image.convert("RGB").resize((224, 224), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    buffered = _output_buffer()
+    # 4:2:0 chroma subsampling is the cheapest encode and all CLIP needs
+    image.save(buffered, format="JPEG", quality=85, optimize=False, subsampling=2)
+    return pybase64.b64encode(buffered.getvalue()).decode('ascii')
 
-# Function to handle a single input or batch query for embedding
-def process_embedding(input_data: Union[str, dict, List[Union[str, dict]]]):
-    # Prepare input format for Jina API
-    def prepare_input(data):
-        if isinstance(data, str):
-            if data.startswith('http'):
-                # Image URL: Fetch and resize with error handling
-                logger.info("Processing as image URL")
-                try:
-                    image_response = requests.get(data, headers=IMAGE_HEADERS, timeout=5)
-                    if image_response.status_code == 200:
-                        resized_image_base64 = resize_image(image_response.content)
-                        return {"image": resized_image_base64}
-                    else:
-                        logger.error(f"Failed to load image from URL: {data} - Status Code: {image_response.status_code}")
-                        return None  # Skip this image if it can't be loaded
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Exception while loading image: {e}")
-                    return None  # Skip this image if an exception occurs
-            elif data.startswith('/9j/') or data.startswith('R0lGOD') or data.startswith("data:image"):
-                # Base64 image: Resize
-                logger.info("Processing as base64 image")
-                try:
-                    # Handle both formats: with data:image prefix or just the base64 string
-                    if data.startswith("data:image"):
-                        # Split by the base64 indicator
-                        image_data = base64.b64decode(data.split(",")[1])
-                    else:
-                        image_data = base64.b64decode(data)
-                    resized_image_base64 = resize_image(image_data)
-                    return {"image": resized_image_base64}
-                except Exception as e:
-                    logger.error(f"Failed to decode base64 image: {e}")
-                    return None  # Skip this image if decoding fails
-            else:
-                # Text input
-                logger.info("Processing as text")
-                return {"text": data}
-        elif isinstance(data, dict):
-            # If it's already a dict with 'image_or_text' key
-            if 'image_or_text' in data:
-                return prepare_input(data['image_or_text'])
-            return {key: prepare_input(value) for key, value in data.items()}
-        else:
-            logger.warning("Unsupported input type")
-            return None  # Skip unsupported input types
+# Recently resized images, keyed by a digest of the original bytes, so
+# retries and repeat submissions of the same photo skip the resize
+RESIZE_CACHE_SIZE = 256
+_resize_cache = OrderedDict()
+_resize_cache_lock = threading.Lock()
 
-    # If input_data is a single item, wrap it in a list for batch processing
-    if not isinstance(input_data, list):
-        input_data = [input_data]
+def resize_image_cached(image_data: bytes) -> str:
+    key = hashlib.blake2s(image_data).digest()
+    with _resize_cache_lock:
+        if key in _resize_cache:
+            _resize_cache.move_to_end(key)
+            return _resize_cache[key]
+    resized = resize_image(image_data)
+    with _resize_cache_lock:
+        _resize_cache[key] = resized
+        if len(_resize_cache) > RESIZE_CACHE_SIZE:
+            _resize_cache.popitem(last=False)
+    return resized
 
-    # Format input data for the API, skipping any None results from failed images
-    inputs = [prepared for prepared in (prepare_input(item) for item in input_data) if prepared]
-    logger.info(f"Formatted {len(inputs)} inputs for Jina API")
+# Dedicated pool for image decode/resize/encode, sized to the CPU count.
+# Pillow releases the GIL while decoding and resampling, so these threads
+# run in parallel, and they don't compete with other to_thread users for
+# the loop's small default executor.
+_resize_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="resize")
 
-    if not inputs:
-        logger.error("No valid inputs could be prepared for the embedding API")
-        return None
+async def resize_image_async(image_data: bytes) -> str:
+    """Run resize_image (through its cache) on the resize pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_resize_executor, resize_image_cached, image_data)
+
+# Largest remote image we'll download; bigger ones are rejected rather
+# than buffered whole in memory
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Fail fast on unreachable hosts and stalled reads (httpx limits are per
+# phase: 2s to connect, 5s per read/write)...
+IMAGE_FETCH_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+# ...and bound the whole download, so a server dripping bytes just under
+# the read timeout can't hold a request open for the full MAX_IMAGE_BYTES
+IMAGE_FETCH_DEADLINE = 10.0
+# Content types accepted for image URLs (some hosts serve images as
+# generic binary)
+IMAGE_CONTENT_TYPES = ("image/", "application/octet-stream")
+
+async def fetch_image(url: str):
+    """
+    Stream an image from `url` into memory, aborting as soon as it
+    exceeds MAX_IMAGE_BYTES (checked against Content-Length up front,
+    then while reading) or takes longer than IMAGE_FETCH_DEADLINE
+    (asyncio.TimeoutError). Returns the bytes, or None on a non-200
+    status or a non-image Content-Type (e.g. an HTML error page), in
+    which case the body is never downloaded.
+    """
+    return await asyncio.wait_for(_download_image(url), IMAGE_FETCH_DEADLINE)
+
+async def _download_image(url: str):
+    async with _client.stream("GET", url, headers=IMAGE_HEADERS, timeout=IMAGE_FETCH_TIMEOUT) as response:
+        if response.status_code != 200:
+            logger.error(f"Failed to load image from URL: {url} - Status Code: {response.status_code}")
+            return None
+        content_type = response.headers.get("Content-Type", "")
+        if not content_type.lower().startswith(IMAGE_CONTENT_TYPES):
+            logger.error(f"URL did not return an image: {url} - Content-Type: {content_type!r}")
+            return None
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+            raise ValueError(f"Image at {url} is too large ({content_length} bytes)")
+        buffered = bytearray()
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            buffered += chunk
+            if len(buffered) > MAX_IMAGE_BYTES:
+                raise ValueError(f"Image at {url} exceeds {MAX_IMAGE_BYTES} bytes")
+        return bytes(buffered)
 
+# Prepare one input in the format the Jina API expects: images are
+# fetched/decoded and resized, anything else is sent as text. Returns
+# None for inputs that can't be used.
+async def prepare_input(data):
+    if isinstance(data, str):
+        if data.startswith('http'):
+            # Image URL: Fetch and resize with error handling
+            logger.info("Processing as image URL")
+            try:
+                image_data = await fetch_image(data)
+                if image_data is None:
+                    return None  # Skip this image if it can't be loaded
+                resized_image_base64 = await resize_image_async(image_data)
+                return {"image": resized_image_base64}
+            except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as e:
+                logger.error(f"Exception while loading image: {e!r}")
+                return None  # Skip this image if an exception occurs
+        elif (data_url := _DATA_URL_RE.match(data)) or data.startswith(IMAGE_MAGIC_B64):
+            # Base64 image: Resize
+            logger.info("Processing as base64 image")
+            try:
+                # Handle both formats: with data:image prefix or just the base64 string
+                payload = data[data_url.end():] if data_url else data
+                image_data = pybase64.b64decode(payload, validate=False)
+                resized_image_base64 = await resize_image_async(image_data)
+                return {"image": resized_image_base64}
+            except Exception as e:
+                logger.error(f"Failed to decode base64 image: {e}")
+                return None  # Skip this image if decoding fails
+        else:
+            # Text input
+            logger.info("Processing as text")
+            return {"text": data}
+    elif isinstance(data, dict):
+        # If it's already a dict with 'image_or_text' key
+        if 'image_or_text' in data:
+            return await prepare_input(data['image_or_text'])
+        # Prepare every field concurrently rather than one after another
+        values = await asyncio.gather(*(prepare_input(value) for value in data.values()))
+        return dict(zip(data.keys(), values))
+    else:
+        logger.warning("Unsupported input type")
+        return None  # Skip unsupported input types
+
+# Jina call limits: a batched request of many images can take a while to
+# embed, so reads get longer than the client default, but never unbounded;
+# a hung connection would otherwise stall every caller coalesced into it
+JINA_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# Send prepared inputs to Jina's CLIP API; returns a (len(inputs), dim)
+# float32 array, one row per input in input order
+async def _post_embeddings(inputs: list) -> np.ndarray:
     # Data payload for API request
     data = {
         "model": "jina-clip-v1",
         "normalized": True,
-        "embedding_type": "float",
+        # Raw little-endian float32 bytes, base64-encoded: far smaller
+        # and cheaper to parse than 768 JSON float literals per input
+        "embedding_type": "base64",
         "input": inputs
     }
 
     # Send request to Jina's Clip API
     try:
-        response = requests.post(API_URL, headers=HEADERS, json=data)
+        # Serialise with orjson rather than httpx's stdlib json: the body is
+        # mostly long base64 image strings, which orjson copies far faster.
+        # HEADERS already carries the application/json Content-Type.
+        response = await _client.post(API_URL, headers=HEADERS, content=orjson.dumps(data), timeout=JINA_TIMEOUT)
         logger.info(f"Jina API response status code: {response.status_code}")
-        
+
         if response.status_code == 200:
-            # Extract embeddings from the nested structure
-            response_data = response.json().get("data", [])
-            embeddings = [entry.get("embedding") for entry in response_data]
-            return embeddings[0] if len(embeddings) == 1 else embeddings  # Return single embedding if only one input
+            # Decode each base64 embedding straight into a float32 buffer
+            response_data = orjson.loads(response.content).get("data", [])
+            response_data.sort(key=lambda entry: entry.get("index", 0))
+            return np.stack([
+                np.frombuffer(pybase64.b64decode(entry["embedding"]), dtype="<f4")
+                for entry in response_data
+            ]).astype(np.float32, copy=False)
         else:
             logger.error(f"Failed to get embeddings: {response.status_code} - {response.text}")
             raise ValueError(f"Failed to get embeddings: {response.status_code} - {response.text}")
     except Exception as e:
         logger.exception(f"Exception during Jina API call: {e}")
         raise
+
+# Embeddings of recently seen inputs, keyed by a digest of the prepared
+# input (resized image base64 or text), so repeat images skip the Jina
+# call entirely. Stored int8-quantised (4x smaller than float32) to fit
+# more entries; only touched from the event loop, so no lock is needed.
+EMBEDDING_CACHE_SIZE = 10_000
+_embedding_cache = OrderedDict()
+
+def _embedding_cache_key(prepared) -> bytes:
+    return hashlib.blake2s(orjson.dumps(prepared, option=orjson.OPT_SORT_KEYS)).digest()
+
+# Symmetric per-vector int8 quantisation: scale = max|v| / 127. Cosine
+# similarity of normalised CLIP vectors moves by well under 1%.
+def _quantize(embedding: np.ndarray):
+    scale = float(np.abs(embedding).max()) / 127 or 1.0
+    return scale, np.round(embedding / scale).astype(np.int8)
+
+def _dequantize(entry) -> np.ndarray:
+    scale, q = entry
+    return q.astype(np.float32) * np.float32(scale)
+
+# Embeddings for prepared inputs, one float32 row per input in input
+# order; only cache misses are sent to the Jina API
+async def request_embeddings(inputs: list) -> np.ndarray:
+    keys = [_embedding_cache_key(prepared) for prepared in inputs]
+    rows = [None] * len(inputs)
+    misses = []
+    for i, key in enumerate(keys):
+        cached = _embedding_cache.get(key)
+        if cached is None:
+            misses.append(i)
+        else:
+            _embedding_cache.move_to_end(key)
+            rows[i] = _dequantize(cached)
+    if misses:
+        logger.info(f"Embedding cache: {len(inputs) - len(misses)} hits, {len(misses)} misses")
+        fetched = await _post_embeddings([inputs[i] for i in misses])
+        if len(fetched) != len(misses):
+            raise ValueError(f"Expected {len(misses)} embeddings, got {len(fetched)}")
+        for i, embedding in zip(misses, fetched):
+            rows[i] = embedding
+            _embedding_cache[keys[i]] = _quantize(embedding)
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+    return np.stack(rows)
+
+# Function to handle a single input or batch query for embedding
+async def process_embedding(input_data: Union[str, dict, List[Union[str, dict]]]):
+    # If input_data is a single item, wrap it in a list for batch processing
+    if not isinstance(input_data, list):
+        input_data = [input_data]
+
+    # Fetch and resize all inputs concurrently, skipping any that failed
+    prepared = await asyncio.gather(
+        *(prepare_input(item) for item in input_data),
+        return_exceptions=True
+    )
+    inputs = []
+    for item in prepared:
+        if isinstance(item, Exception):
+            logger.error(f"Failed to prepare input: {item}")
+        elif item:
+            inputs.append(item)
+    logger.info(f"Formatted {len(inputs)} inputs for Jina API")
+
+    if not inputs:
+        logger.error("No valid inputs could be prepared for the embedding API")
+        return None
+
+    embeddings = await request_embeddings(inputs)
+    return embeddings[0] if len(embeddings) == 1 else embeddings  # Return single embedding if only one input
+
+
+class BatchingEmbeddingClient:
+    """
+    Coalesces concurrent single-input embedding requests into batched
+    Jina API calls. Each embed() prepares its own input, then queues it;
+    a background task sends up to `max_batch` queued inputs per POST,
+    waiting at most `max_wait` seconds after the first one arrives, and
+    hands each caller back its own row. K concurrent requests cost one
+    round trip to api.jina.ai instead of K.
+    """
+
+    def __init__(self, max_batch: int = 32, max_wait: float = 0.008):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._worker = None
+        self._in_flight = set()
+
+    async def embed(self, item):
+        """Embedding for a single input, or None if it can't be prepared."""
+        prepared = await prepare_input(item)
+        if not prepared:
+            return None
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prepared, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Send without waiting, so the next batch can fill while this
+            # one is in flight
+            task = asyncio.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch):
+        logger.info(f"Sending batch of {len(batch)} coalesced inputs to Jina API")
+        try:
+            embeddings = await request_embeddings([prepared for prepared, _ in batch])
+            if len(embeddings) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(embeddings)}")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    async def close(self):
+        """Stop the background task; called on app shutdown."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+
+# Shared coalescer for the single-image request path
+embedding_batcher = BatchingEmbeddingClient()
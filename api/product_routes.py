@@ -1,66 +1,98 @@
+import binascii
 import logging
+import numpy as np
+import pybase64
 from fastapi import APIRouter, HTTPException, Request
-from api.embedding import process_embedding
-from services.database import find_similar_image, insert_image_and_metadata
-from typing import Optional
+from api.embedding import _DATA_URL_RE, embedding_batcher, process_embedding
+from services.database import (
+    EMBEDDING_DIM, find_similar_image, get_image_base64, insert_image_and_metadata
+)
+from pydantic import BaseModel
+from typing import List, Optional, Union
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-@router.post("/submission")
-async def submission(request: Request):
+# Largest base64 image /add-image accepts (~1.5 MB decoded); every byte is
+# stored per row and sent back with each match
+MAX_IMAGE_BASE64_LEN = 2 * 1024 * 1024
+
+class SubmissionReq(BaseModel):
+    # A single image (base64, data URL or http URL), or a batch of them
+    image: Union[str, dict, List[Union[str, dict]]]
+
+
+async def _handle_submission(payload: SubmissionReq) -> dict:
     """
     Process incoming image, get its embedding, 
     find the most similar face in the DB, 
     and return all attributes in the JSON format the frontend expects.
     """
-    try:
-        data = await request.json()
-        
-        if 'image' not in data:
-            logger.error("Missing 'image' field in request")
-            raise HTTPException(status_code=400, detail="Missing 'image' field in request")
-        
-        # Generate embedding from the image
-        user_input_embedding = process_embedding(data['image'])
-        if not user_input_embedding:
-            logger.error("Failed to generate embedding for the input image")
-            raise HTTPException(status_code=400, detail="Failed to process image")
-        
-        # Find the most similar record
-        similar_images = find_similar_image(user_input_embedding, limit=1)
-        if not similar_images:
-            logger.warning("No similar images found in the database")
-            return {"results": []}
-        
-        most_similar = similar_images[0]
-        
-        # Log the matchPercent
-        logger.info(f"Found similar image with matchPercent: {most_similar['matchPercent']}")
-        
-        # Round matchPercent
-        matchPercent = round(most_similar["matchPercent"], 3)
-
-        # Return the JSON in the shape your frontend wants
-        response_json = {
-            "image": most_similar["image"],     # or "image_base64" if your DB function returns that key
-            "offense": most_similar["offense"],
-            "height": most_similar["height"],
-            "weight": most_similar["weight"],
-            "hairColor": most_similar["hairColor"],
-            "eyeColor": most_similar["eyeColor"],
-            "race": most_similar["race"],
-            "sexOffender": most_similar["sexOffender"],
-            "matchPercent": matchPercent
-        }
-
-        return response_json
+    # Generate embedding from the image. Single images go through the
+    # shared batcher so concurrent submissions share one Jina API call
+    if isinstance(payload.image, list):
+        user_input_embedding = await process_embedding(payload.image)
+    else:
+        user_input_embedding = await embedding_batcher.embed(payload.image)
+    if user_input_embedding is None:
+        logger.error("Failed to generate embedding for the input image")
+        raise HTTPException(status_code=400, detail="Failed to process image")
+
+    # Find the most similar record
+    similar_images = await find_similar_image(user_input_embedding, limit=1)
+    if not similar_images:
+        logger.warning("No similar images found in the database")
+        return {"results": []}
+
+    most_similar = similar_images[0]
 
+    # Log the matchPercent
+    logger.info(f"Found similar image with matchPercent: {most_similar['matchPercent']}")
+
+    # Round matchPercent
+    matchPercent = round(most_similar["matchPercent"], 3)
+
+    # Return the JSON in the shape your frontend wants
+    return {
+        "image": most_similar["image"],     # or "image_base64" if your DB function returns that key
+        "offense": most_similar["offense"],
+        "height": most_similar["height"],
+        "weight": most_similar["weight"],
+        "hairColor": most_similar["hairColor"],
+        "eyeColor": most_similar["eyeColor"],
+        "race": most_similar["race"],
+        "sexOffender": most_similar["sexOffender"],
+        "matchPercent": matchPercent
+    }
+
+
+@router.post("/submission")
+async def submission(payload: SubmissionReq):
+    """
+    Request body is validated by FastAPI against SubmissionReq; a missing
+    'image' field is rejected before this handler runs.
+    """
+    try:
+        return await _handle_submission(payload)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"An error occurred while processing image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
 
+@router.get("/image/{filename}")
+async def get_image(filename: str):
+    """
+    Fetch the base64 image for a single match on demand, for callers
+    that searched without images.
+    """
+    image = await get_image_base64(filename)
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"No image for '{filename}'")
+    return {"filename": filename, "image": image}
+
+
 @router.post("/add-image")
 async def add_image(request: Request):
     """
@@ -91,12 +123,41 @@ async def add_image(request: Request):
                     status_code=400, 
                     detail=f"Missing '{field}' in request payload"
                 )
+
+        # Reject oversized or malformed images before they reach the table.
+        # Data URLs are accepted as before (and stored as sent); only the
+        # part after the "data:image/...;base64," prefix has to be base64.
+        image = data["image"]
+        if not isinstance(image, str):
+            raise HTTPException(status_code=400, detail="'image' must be a base64 string")
+        if len(image) > MAX_IMAGE_BASE64_LEN:
+            raise HTTPException(
+                status_code=413,
+                detail=f"'image' must be at most {MAX_IMAGE_BASE64_LEN} characters"
+            )
+        data_url = _DATA_URL_RE.match(image)
+        try:
+            pybase64.b64decode(image[data_url.end():] if data_url else image, validate=True)
+        except (binascii.Error, ValueError):
+            raise HTTPException(status_code=400, detail="'image' is not valid base64")
+
+        # Convert the JSON list to float32 once, here at the boundary; the
+        # DB layer sends it as-is through the binary pgvector codec
+        try:
+            embedding = np.asarray(data["embedding"], dtype=np.float32)
+        except (TypeError, ValueError):
+            embedding = None
+        if embedding is None or embedding.shape != (EMBEDDING_DIM,):
+            raise HTTPException(
+                status_code=400,
+                detail=f"'embedding' must be a list of {EMBEDDING_DIM} numbers"
+            )
         
         # Insert into DB (filename is PK)
-        insert_image_and_metadata(
+        await insert_image_and_metadata(
             filename=data["filename"],
-            image_base64=data["image"],
-            embedding=data["embedding"],
+            image_base64=image,
+            embedding=embedding,
             sex=data.get("sex", "Unknown"),  # optional
             height=data["height"],
             weight=data["weight"],
@@ -109,6 +170,8 @@ async def add_image(request: Request):
         
         return {"id": data["filename"], "message": "Image + metadata added successfully"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error adding image to database: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to add image: {str(e)}")
@@ -2,8 +2,14 @@
 
 import logging
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends
+from fastapi.responses import ORJSONResponse
 from api import product_routes
+from api.embedding import close_http_client, embedding_batcher
+from services.database import (
+    check_schema, close_pool, init_pool, warm_up
+)
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
@@ -29,11 +35,29 @@ if not os.environ.get('JINA_API_KEY'):
     logger.warning("JINA_API_KEY not found in environment variables. API calls will fail.")
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the database pool, make sure the schema is migrated and the ANN
+    # index usable (schema changes themselves live in migrate_db.py), then
+    # pull the vector indexes into memory before serving traffic
+    await init_pool()
+    await check_schema()
+    await warm_up()
+    yield
+    # Stop the embedding batcher, then close pooled keep-alive and
+    # database connections on shutdown
+    await embedding_batcher.close()
+    await close_http_client()
+    await close_pool()
+
+
 # Initialize the FastAPI app
 app = FastAPI(
     title="FaceCrime Backend API",
     description="API for detecting similar faces using Jina embeddings and MongoDB",
-    version="0.1.0"
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 origins = [
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+One-off schema migrations for the database in MANUFACTURER_DB_*, run by
+hand rather than at app startup:
+
+    python migrate_db.py
+
+Each step checks the current state first, so re-running is safe. Set
+MIGRATE_IVFFLAT=1 to also build the IVFFlat index for bulk searches
+(optionally with MIGRATE_IVFFLAT_LISTS=<n>); do that once the table is
+loaded.
+"""
+import asyncio
+import os
+import asyncpg
+from services.database import (
+    HNSW_EF_CONSTRUCTION, HNSW_M, INDEX_BUILD_MAINTENANCE_WORK_MEM,
+    INDEX_BUILD_PARALLEL_WORKERS, INDEX_EXPRESSION, INDEX_OPCLASS,
+    check_pgvector_version, dsn, vector_index_status
+)
+
+BUILD_IVFFLAT = os.environ.get("MIGRATE_IVFFLAT") == "1"
+IVFFLAT_LISTS = os.environ.get("MIGRATE_IVFFLAT_LISTS")
+
+
+async def install_extensions(conn):
+    """
+    pg_prewarm backs the app's startup warm-up; creating it needs more
+    privileges than the app role should have, so it is done here.
+    """
+    await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
+    print("pg_prewarm is installed")
+
+
+async def split_images(conn):
+    """
+    Move image_base64 out of 'facecrime_data' into its own table,
+    'facecrime_image' (filename -> image_base64), so the heap pages that
+    searches touch hold only vectors and metadata. Images are copied
+    over and the column dropped in one transaction, with facecrime_data
+    locked against writes first so no row committed mid-copy loses its
+    image to the DROP COLUMN (searches keep running until the drop).
+    """
+    has_column = await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'facecrime_data' AND column_name = 'image_base64')"
+    )
+    async with conn.transaction():
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS facecrime_image ("
+            "filename text PRIMARY KEY REFERENCES facecrime_data (filename) ON DELETE CASCADE, "
+            "image_base64 text NOT NULL)"
+        )
+        if not has_column:
+            print("Images are already in facecrime_image")
+            return
+        await conn.execute("LOCK TABLE facecrime_data IN SHARE ROW EXCLUSIVE MODE")
+        print("Copying images into facecrime_image ...")
+        await conn.execute(
+            "INSERT INTO facecrime_image (filename, image_base64) "
+            "SELECT filename, image_base64 FROM facecrime_data "
+            "WHERE image_base64 IS NOT NULL "
+            "ON CONFLICT (filename) DO NOTHING"
+        )
+        await conn.execute("ALTER TABLE facecrime_data DROP COLUMN image_base64")
+    # DROP COLUMN only hides the data; the space comes back on a rewrite
+    print("Moved images to facecrime_image; run VACUUM FULL facecrime_data "
+          "(or pg_repack) in a quiet window to reclaim the old space")
+
+
+async def build_vector_index(conn):
+    """
+    (Re)build the HNSW index 'idx_fc_emb' if it is missing or doesn't
+    match the settings in services/database.py. The new index is built
+    CONCURRENTLY under a temporary name, so searches and inserts keep
+    running on the old one; only the final rename swap takes a lock,
+    and the old index is then dropped concurrently.
+    """
+    indexdef, current = await vector_index_status(conn)
+    if current:
+        print("HNSW index idx_fc_emb is already up to date")
+        return
+    # Leftover (invalid) index from an interrupted earlier run
+    await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_fc_emb_new")
+    await conn.execute(f"SET maintenance_work_mem = '{INDEX_BUILD_MAINTENANCE_WORK_MEM}'")
+    await conn.execute(f"SET max_parallel_maintenance_workers = {INDEX_BUILD_PARALLEL_WORKERS}")
+    print("Building HNSW index idx_fc_emb_new ...")
+    await conn.execute(
+        "CREATE INDEX CONCURRENTLY idx_fc_emb_new ON facecrime_data "
+        f"USING hnsw ({INDEX_EXPRESSION} {INDEX_OPCLASS}) "
+        f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+    )
+    async with conn.transaction():
+        if indexdef is not None:
+            await conn.execute("ALTER INDEX idx_fc_emb RENAME TO idx_fc_emb_old")
+        await conn.execute("ALTER INDEX idx_fc_emb_new RENAME TO idx_fc_emb")
+    if indexdef is not None:
+        await conn.execute("DROP INDEX CONCURRENTLY idx_fc_emb_old")
+        print(f"Replaced old index ({indexdef})")
+    print("Built HNSW index idx_fc_emb")
+
+
+async def build_ivfflat_index(conn, lists=None):
+    """
+    Build the IVFFlat index 'idx_fc_ivf' on 'facecrime_data.embedding'
+    (cosine distance) CONCURRENTLY if it doesn't exist. IVFFlat trains
+    its clusters on the rows present at build time, so an empty table is
+    refused. `lists` defaults to about sqrt(row count).
+    """
+    valid = await conn.fetchval(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('idx_fc_ivf')"
+    )
+    if valid:
+        print("IVFFlat index idx_fc_ivf already exists")
+        return
+    if valid is not None:
+        # Leftover (invalid) index from an interrupted earlier run
+        await conn.execute("DROP INDEX CONCURRENTLY idx_fc_ivf")
+    rows = await conn.fetchval("SELECT count(*) FROM facecrime_data")
+    if rows == 0:
+        print("facecrime_data is empty; load it before building idx_fc_ivf")
+        return
+    if lists is None:
+        lists = max(1, int(rows ** 0.5))
+    await conn.execute(f"SET maintenance_work_mem = '{INDEX_BUILD_MAINTENANCE_WORK_MEM}'")
+    print(f"Building IVFFlat index idx_fc_ivf (lists={lists}) ...")
+    await conn.execute(
+        "CREATE INDEX CONCURRENTLY idx_fc_ivf ON facecrime_data "
+        f"USING ivfflat (embedding vector_cosine_ops) WITH (lists = {int(lists)})"
+    )
+    print("Built IVFFlat index idx_fc_ivf")
+
+
+async def main():
+    conn = await asyncpg.connect(dsn)
+    try:
+        await check_pgvector_version(conn)
+        await install_extensions(conn)
+        await split_images(conn)
+        await build_vector_index(conn)
+        if BUILD_IVFFLAT:
+            await build_ivfflat_index(conn, int(IVFFLAT_LISTS) if IVFFLAT_LISTS else None)
+    finally:
+        await conn.close()
+    print("✅ Done.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,9 @@
 import os
 import logging
-import datetime
-import psycopg2
-import psycopg2.extras
+import asyncpg
+import numpy as np
+from pgvector import Vector
+from pgvector.asyncpg import register_vector
 
 logger = logging.getLogger(__name__)
 
@@ -13,18 +14,310 @@ DB_NAME = os.environ.get("MANUFACTURER_DB_DB", "facecrime")
 DB_USER = os.environ.get("MANUFACTURER_DB_USER", "facecrimeuser")
 DB_PASSWORD = os.environ.get("MANUFACTURER_DB_PASSWORD", "facecrimepass")
 
-conn_str = (
-    f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} "
-    f"user={DB_USER} password={DB_PASSWORD}"
-)
+dsn = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Connections are pooled per process rather than opened per query. The
+# sizes are per uvicorn worker, so workers x POOL_MAX_SIZE must stay under
+# the server's max_connections (100 by default): 4 x 20 leaves headroom
+# for migrations and admin sessions. Override per deployment if needed.
+POOL_MIN_SIZE = int(os.environ.get("MANUFACTURER_DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.environ.get("MANUFACTURER_DB_POOL_MAX_SIZE", "20"))
+POOL_MAX_INACTIVE_LIFETIME = 300
+_pool = None
+
+async def init_pool():
+    """
+    Create the process-wide asyncpg pool; called on app startup.
+    Every new connection registers pgvector's binary codec, so vectors
+    go over the wire as packed float32 instead of '[x,y,...]' text.
+    """
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            dsn,
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=POOL_MAX_INACTIVE_LIFETIME,
+            init=register_vector
+        )
+
+async def close_pool():
+    """
+    Close every pooled connection, and the prewarm lock connection if
+    this worker holds it; called on app shutdown.
+    """
+    global _pool, _prewarm_conn
+    if _prewarm_conn is not None:
+        await _prewarm_conn.close()
+        _prewarm_conn = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
 
 def get_connection():
-    return psycopg2.connect(conn_str)
+    """
+    Acquire a connection from the pool for the duration of an
+    `async with` block.
+    """
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialised; call init_pool() first")
+    return _pool.acquire()
+
+# Width of the jina-clip-v1 embeddings stored in facecrime_data.embedding
+EMBEDDING_DIM = 768
+
+def _vector_param(embedding):
+    """
+    Embeddings travel through the pipeline as float32 numpy arrays and
+    are handed to the driver as-is; the pgvector codec registered on
+    each connection packs them into the binary wire format.
+    """
+    return np.asarray(embedding, dtype=np.float32)
+
+# HNSW build parameters for the cosine-distance index on 'embedding',
+# and the default search-time candidate list size (pgvector's is 40)
+HNSW_M = 24
+HNSW_EF_CONSTRUCTION = 128
+HNSW_EF_SEARCH = 100
+# HNSW returns at most ef_search rows, so the default scales with the
+# limit; pgvector caps hnsw.ef_search at 1000
+HNSW_EF_SEARCH_PER_RESULT = 20
+HNSW_EF_SEARCH_MAX = 1000
+# Session settings used only while (re)building the index (migrate_db.py)
+INDEX_BUILD_MAINTENANCE_WORK_MEM = "2GB"
+INDEX_BUILD_PARALLEL_WORKERS = 7
+# The index stores vectors as fp16 (halfvec, pgvector >= 0.7): half the
+# size of the float32 column, so twice as much of the graph fits in
+# shared buffers. Queries must order by this exact expression to use it.
+# Both are built from EMBEDDING_DIM so the index and the queries can't drift.
+VECTOR_TYPE = f"vector({EMBEDDING_DIM})"
+INDEX_VECTOR_TYPE = f"halfvec({EMBEDDING_DIM})"
+INDEX_EXPRESSION = f"(embedding::{INDEX_VECTOR_TYPE})"
+INDEX_OPCLASS = "halfvec_cosine_ops"
+# Oldest pgvector with halfvec; the searches below cast to it
+PGVECTOR_MIN_VERSION = (0, 7, 0)
+
+def _index_distance(query: str) -> str:
+    """
+    Cosine distance from the stored vectors to `query` (a SQL vector
+    expression), written exactly as idx_fc_emb indexes it, so ORDER BY
+    on it is answered by the HNSW index.
+    """
+    return f"{INDEX_EXPRESSION} <=> {query}::{INDEX_VECTOR_TYPE}"
+
+async def check_pgvector_version(conn):
+    """
+    Raise RuntimeError unless the 'vector' extension is installed at
+    PGVECTOR_MIN_VERSION or newer; older versions fail on the halfvec
+    casts with an unhelpful "type does not exist".
+    """
+    version = await conn.fetchval(
+        "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+    )
+    if version is None:
+        raise RuntimeError("The pgvector extension is not installed in this database")
+    parsed = tuple(int(part) for part in version.split(".")[:3] if part.isdigit())
+    if parsed < PGVECTOR_MIN_VERSION:
+        wanted = ".".join(map(str, PGVECTOR_MIN_VERSION))
+        raise RuntimeError(
+            f"pgvector {version} is installed but {wanted} or newer is required "
+            f"(halfvec index); run ALTER EXTENSION vector UPDATE"
+        )
+
+async def vector_index_status(conn):
+    """
+    Return (indexdef, current) for 'idx_fc_emb': its definition (None if
+    it doesn't exist) and whether it is a valid HNSW index over
+    INDEX_EXPRESSION built with HNSW_M / HNSW_EF_CONSTRUCTION.
+    """
+    wanted = sorted([f"m={HNSW_M}", f"ef_construction={HNSW_EF_CONSTRUCTION}"])
+    existing = await conn.fetchrow(
+        "SELECT c.reloptions, i.indisvalid, pg_get_indexdef(c.oid) AS indexdef "
+        "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "WHERE c.oid = to_regclass('idx_fc_emb')"
+    )
+    if existing is None:
+        return None, False
+    current = (
+        existing["indisvalid"]
+        and sorted(existing["reloptions"] or []) == wanted
+        and INDEX_OPCLASS in existing["indexdef"]
+    )
+    return existing["indexdef"], current
+
+async def check_schema():
+    """
+    Startup check that the database is migrated far enough to serve.
+    Fails if pgvector is too old for the halfvec searches, or if the
+    'facecrime_image' table doesn't exist yet (every search and insert
+    would fail); run migrate_db.py first. Warns if the HNSW index
+    idx_fc_emb is missing or out of date, in which case searches fall
+    back to an exact O(N) scan until migrate_db.py rebuilds it. The app
+    never builds the index itself: a build locks out writes for its
+    whole duration and would stall every worker's startup.
+    """
+    async with get_connection() as conn:
+        await check_pgvector_version(conn)
+        if await conn.fetchval("SELECT to_regclass('facecrime_image')") is None:
+            raise RuntimeError(
+                "Table facecrime_image does not exist; run migrate_db.py before starting the app"
+            )
+        indexdef, current = await vector_index_status(conn)
+    if current:
+        logger.info("HNSW index idx_fc_emb is in place")
+    elif indexdef is None:
+        logger.warning("HNSW index idx_fc_emb is missing; run migrate_db.py")
+    else:
+        logger.warning(f"HNSW index idx_fc_emb is out of date ({indexdef}); run migrate_db.py")
+
+# Dedicated connection holding the session-level prewarm lock for as long
+# as this worker runs (released by close_pool)
+_prewarm_conn = None
+
+async def warm_up():
+    """
+    Load the indexes of 'facecrime_data' (the HNSW graph holds the
+    vectors searches walk) into Postgres shared buffers with pg_prewarm,
+    so the first searches after a (re)start don't pay for cold disk
+    reads. The heap itself is left alone. Only one worker prewarms: it
+    takes a session-level advisory lock on its own connection and keeps
+    it until shutdown, so the other workers, including ones that start
+    after it has finished, fail the try-lock and move on.
+    pg_prewarm is installed by migrate_db.py; without it this is a no-op.
+    """
+    global _prewarm_conn
+    conn = None
+    try:
+        conn = await asyncpg.connect(dsn)
+        if not await conn.fetchval(
+            "SELECT pg_try_advisory_lock(hashtext('facecrime_prewarm'))"
+        ):
+            return
+        _prewarm_conn, conn = conn, None
+        if not await _prewarm_conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm')"
+        ):
+            logger.info("pg_prewarm is not installed; skipping prewarm")
+            return
+        await _prewarm_conn.execute(
+            "SELECT pg_prewarm(indexrelid) FROM pg_index "
+            "WHERE indrelid = 'facecrime_data'::regclass"
+        )
+        logger.info("Prewarmed the facecrime_data indexes")
+    except Exception as e:
+        logger.warning(f"Could not prewarm facecrime_data: {e}")
+    finally:
+        if conn is not None:
+            await conn.close()
+
+# Images live in their own table, 'facecrime_image' (filename, image_base64),
+# split out of 'facecrime_data' by migrate_db.py: the vector/metadata heap
+# that searches touch stays narrow, and a match's image is only read for
+# the top-k rows that are returned.
+
+# Single-row INSERT shared by the insert paths; executemany pipelines it.
+# The image row is only written when the metadata row was new.
+INSERT_SQL = f"""
+WITH inserted AS (
+    INSERT INTO facecrime_data
+        (filename, embedding, sex, height, weight,
+         hairColor, eyeColor, race, sexOffender, offense, created_at)
+    VALUES ($1, $3::{VECTOR_TYPE}, $4, $5, $6, $7, $8, $9, $10, $11, now())
+    ON CONFLICT (filename) DO NOTHING
+    RETURNING filename
+)
+INSERT INTO facecrime_image (filename, image_base64)
+SELECT filename, $2 FROM inserted
+"""
+
+# Large batches are COPYed into a temp staging table (binary protocol, one
+# round-trip) and moved over with a single INSERT ... SELECT, which keeps
+# the ON CONFLICT skip and now() timestamp that plain COPY can't do
+COPY_THRESHOLD = 100
+COPY_COLUMNS = [
+    "filename", "image_base64", "embedding", "sex", "height", "weight",
+    "haircolor", "eyecolor", "race", "sexoffender", "offense"
+]
+# Exactly the COPY columns, with their types taken from facecrime_data
+# but none of its constraints, defaults or identity columns
+STAGING_TABLE_SQL = """
+CREATE TEMP TABLE facecrime_stage ON COMMIT DROP AS
+SELECT d.filename, i.image_base64, d.embedding, d.sex, d.height, d.weight,
+       d.hairColor, d.eyeColor, d.race, d.sexOffender, d.offense
+FROM facecrime_data d
+JOIN facecrime_image i USING (filename)
+WITH NO DATA
+"""
+# A filename repeated within one batch is merged once (both tables read
+# the same deduplicated rows), as executemany would skip the repeat
+MERGE_STAGING_SQL = """
+WITH staged AS (
+    SELECT DISTINCT ON (filename) *
+    FROM facecrime_stage
+),
+inserted AS (
+    INSERT INTO facecrime_data
+        (filename, embedding, sex, height, weight,
+         hairColor, eyeColor, race, sexOffender, offense, created_at)
+    SELECT filename, embedding, sex, height, weight,
+           hairColor, eyeColor, race, sexOffender, offense, now()
+    FROM staged
+    ON CONFLICT (filename) DO NOTHING
+    RETURNING filename
+)
+INSERT INTO facecrime_image (filename, image_base64)
+SELECT s.filename, s.image_base64
+FROM staged s
+JOIN inserted USING (filename)
+"""
 
-def insert_image_and_metadata(
+async def insert_images_bulk(records: list):
+    """
+    Insert many rows into 'facecrime_data' in a single transaction.
+    Each record is a dict with the same keys as the arguments of
+    insert_image_and_metadata; 'embedding' may be a float32 numpy array
+    (e.g. a row of the generator's Parquet output) or a list.
+    Small batches go through executemany, which pipelines the rows over
+    one prepared statement; batches of COPY_THRESHOLD rows or more are
+    streamed with COPY into a staging table and merged in one statement.
+    Either way N records don't cost N round-trips.
+    Existing filenames are skipped (ON CONFLICT DO NOTHING).
+    """
+    rows = [
+        (
+            r["filename"],
+            r["image_base64"],
+            _vector_param(r["embedding"]),
+            r["sex"],
+            r["height"],
+            r["weight"],
+            r["hairColor"],
+            r["eyeColor"],
+            r["race"],
+            r["sexOffender"],
+            r["offense"]
+        )
+        for r in records
+    ]
+    try:
+        async with get_connection() as conn:
+            async with conn.transaction():
+                if len(rows) >= COPY_THRESHOLD:
+                    await conn.execute(STAGING_TABLE_SQL)
+                    await conn.copy_records_to_table(
+                        "facecrime_stage", records=rows, columns=COPY_COLUMNS
+                    )
+                    await conn.execute(MERGE_STAGING_SQL)
+                else:
+                    await conn.executemany(INSERT_SQL, rows)
+        logger.info(f"Inserted {len(rows)} rows")
+    except Exception as e:
+        logger.error(f"Failed to insert data: {e}")
+
+async def insert_image_and_metadata(
     filename: str,
     image_base64: str,
-    embedding: list,
+    embedding: np.ndarray,
     sex: str,
     height: str,
     weight: str,
@@ -36,93 +329,250 @@ def insert_image_and_metadata(
 ):
     """
     Insert a row into the 'facecrime_data' table with a 768-d vector,
-    storing everything in Postgres (pgvector).
+    and its image into 'facecrime_image', in Postgres (pgvector).
     'filename' is used as the PK for uniqueness.
+    Kept for single-row callers; bulk loads should use insert_images_bulk.
     """
-    try:
-        with get_connection() as conn:
-            with conn.cursor() as cur:
-                # Insert the embedding as a vector(768)
-                sql = """
-                INSERT INTO facecrime_data
-                    (filename, image_base64, embedding, sex, height, weight,
-                     hairColor, eyeColor, race, sexOffender, offense, created_at)
-                VALUES
-                    (%s, %s, %s::vector(768), %s, %s, %s, %s, %s, %s, %s, %s, now())
-                ON CONFLICT (filename) DO NOTHING
-                """
-                cur.execute(sql, (
-                    filename,
-                    image_base64,
-                    embedding,
-                    sex,
-                    height,
-                    weight,
-                    hairColor,
-                    eyeColor,
-                    race,
-                    sexOffender,
-                    offense
-                ))
-        logger.info(f"Inserted data for filename='{filename}'")
-    except Exception as e:
-        logger.error(f"Failed to insert data: {e}")
+    await insert_images_bulk([{
+        "filename": filename,
+        "image_base64": image_base64,
+        "embedding": embedding,
+        "sex": sex,
+        "height": height,
+        "weight": weight,
+        "hairColor": hairColor,
+        "eyeColor": eyeColor,
+        "race": race,
+        "sexOffender": sexOffender,
+        "offense": offense
+    }])
+
+def _default_ef_search(limit: int) -> int:
+    """
+    Candidate list size for a top-`limit` search: HNSW_EF_SEARCH for
+    small k, growing with the limit so large k keeps its recall (and
+    never returns fewer than `limit` rows), capped at pgvector's maximum.
+    """
+    return min(max(HNSW_EF_SEARCH, limit * HNSW_EF_SEARCH_PER_RESULT), HNSW_EF_SEARCH_MAX)
 
-def find_similar_image(embedding: list, limit: int = 1):
+def _match_from_row(row):
+    """Shape a search result row the way the routes expect it."""
+    raw_val = 1.0 - float(row["distance"])
+    # clamp to [0..1]
+    raw_val = max(0.0, min(1.0, raw_val))
+
+    return {
+        "filename": row["filename"],
+        "image": row["image"],  # base64
+        "sex": row["sex"],
+        "height": row["height"],
+        "weight": row["weight"],
+        "hairColor": row["haircolor"],
+        "eyeColor": row["eyecolor"],
+        "race": row["race"],
+        "sexOffender": row["sexoffender"],
+        "offense": row["offense"],
+        "matchPercent": raw_val
+    }
+
+def _image_columns(include_image: bool):
+    """
+    SELECT expression and join for a match's image: facecrime_image is
+    only joined (for the top-k rows) when the image is wanted.
+    """
+    if include_image:
+        return "i.image_base64", "LEFT JOIN facecrime_image i USING (filename)"
+    return "NULL", ""
+
+async def find_similar_image(
+    embedding: np.ndarray,
+    limit: int = 1,
+    include_image: bool = True,
+    ef_search: int = None
+):
     """
-    Perform a similarity search using pgvector's <=> operator, but 
-    we treat <=> as if it were a distance. We compute:
-        matchPercent = 1 - (embedding <=> query_vector)
-    and then ORDER BY matchPercent DESC for top matches.
+    Perform a similarity search using pgvector's <=> (cosine distance)
+    operator. Rows are ordered by the bare distance ascending, the only
+    form the HNSW index (idx_fc_emb) can answer, and we compute:
+        matchPercent = 1 - distance
+    in Python after the fetch.
 
     This yields a 0..1 range for matchPercent (clamped if out of range).
+    With include_image=False the (large) base64 column is not read and
+    'image' is None; fetch it on demand with get_image_base64.
+    ef_search sets hnsw.ef_search for this query only: higher values
+    trade latency for recall. Defaults to _default_ef_search(limit).
     """
+    image_col, image_join = _image_columns(include_image)
+    order_by = _index_distance(f"$1::{VECTOR_TYPE}")
+    embedding = _vector_param(embedding)
     try:
-        with get_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                # We do 1 - (embedding <=> ...) and call that match_percent
-                # Then we sort in descending order so the highest match_percent is first
-                sql = f"""
-                SELECT
-                  filename,
-                  image_base64 AS image,
-                  sex,
-                  height,
-                  weight,
-                  hairColor,
-                  eyeColor,
-                  race,
-                  sexOffender,
-                  offense,
-                  (1 - (embedding <=> %s::vector(768))) AS match_percent
-                FROM facecrime_data
-                ORDER BY (1 - (embedding <=> %s::vector(768))) DESC
-                LIMIT {limit};
-                """
-                cur.execute(sql, (embedding, embedding))
-                rows = cur.fetchall()
-
-                results = []
-                for row in rows:
-                    raw_val = float(row["match_percent"])
-                    # clamp to [0..1]
-                    raw_val = max(0.0, min(1.0, raw_val))
-
-                    results.append({
-                        "filename": row["filename"],
-                        "image": row["image"],  # base64
-                        "sex": row["sex"],
-                        "height": row["height"],
-                        "weight": row["weight"],
-                        "hairColor": row["haircolor"],
-                        "eyeColor": row["eyecolor"],
-                        "race": row["race"],
-                        "sexOffender": row["sexoffender"],
-                        "offense": row["offense"],
-                        "matchPercent": raw_val
-                    })
-                return results
+        async with get_connection() as conn:
+            # ORDER BY must stay the plain `<index expression> <=> $1` ASC:
+            # wrapping it (1 - ..., DESC) stops the planner from using the
+            # HNSW index and falls back to a sequential scan over every vector.
+            # Ranking uses the fp16 index; the reported distance is recomputed
+            # from the float32 column for the k winners.
+            # The ranking step (topk) only touches filename + embedding; the
+            # metadata and the image (from facecrime_image) are joined in for
+            # the k winners alone rather than for every candidate HNSW visits.
+            sql = f"""
+            WITH topk AS (
+              SELECT filename, (embedding <=> $1::{VECTOR_TYPE}) AS distance
+              FROM facecrime_data
+              ORDER BY {order_by}
+              LIMIT $2
+            )
+            SELECT
+              t.filename,
+              {image_col} AS image,
+              f.sex,
+              f.height,
+              f.weight,
+              f.hairColor,
+              f.eyeColor,
+              f.race,
+              f.sexOffender,
+              f.offense,
+              t.distance
+            FROM topk t
+            JOIN facecrime_data f USING (filename)
+            {image_join}
+            ORDER BY t.distance;
+            """
+            async with conn.transaction():
+                # Transaction-scoped, so pooled connections keep the default
+                await conn.execute(
+                    "SELECT set_config('hnsw.ef_search', $1, true)",
+                    str(ef_search or _default_ef_search(limit))
+                )
+                rows = await conn.fetch(sql, embedding, limit)
+
+        return [_match_from_row(row) for row in rows]
 
     except Exception as e:
         logger.error(f"Failed to query similar images: {e}")
         return []
+
+async def _search_batch(embeddings, limit, include_image, order_by, setting, setting_value):
+    """
+    Run one top-`limit` search per query vector in a single statement.
+    `order_by` is the ranking expression over the lateral query vector
+    `q.v`; it decides which index the planner can use. `setting` is the
+    index's per-query knob, set for this transaction only.
+    """
+    image_col, image_join = _image_columns(include_image)
+    # Wrapped in Vector: asyncpg would read bare ndarrays inside a list
+    # as a nested array dimension rather than as vector elements
+    queries = [Vector(_vector_param(e)) for e in embeddings]
+    if not queries:
+        return []
+    try:
+        async with get_connection() as conn:
+            # Same rules as find_similar_image: rank on the bare index
+            # expression inside the lateral subquery, join wide columns
+            # for the winners only
+            sql = f"""
+            WITH q AS (
+              SELECT qid, v
+              FROM unnest($1::{VECTOR_TYPE}[]) WITH ORDINALITY AS u(v, qid)
+            )
+            SELECT
+              q.qid,
+              t.filename,
+              {image_col} AS image,
+              f.sex,
+              f.height,
+              f.weight,
+              f.hairColor,
+              f.eyeColor,
+              f.race,
+              f.sexOffender,
+              f.offense,
+              t.distance
+            FROM q
+            CROSS JOIN LATERAL (
+              SELECT filename, (embedding <=> q.v) AS distance
+              FROM facecrime_data
+              ORDER BY {order_by}
+              LIMIT $2
+            ) t
+            JOIN facecrime_data f USING (filename)
+            {image_join}
+            ORDER BY q.qid, t.distance;
+            """
+            async with conn.transaction():
+                await conn.execute(
+                    "SELECT set_config($1, $2, true)", setting, str(setting_value)
+                )
+                rows = await conn.fetch(sql, queries, limit)
+
+        results = [[] for _ in queries]
+        for row in rows:
+            results[row["qid"] - 1].append(_match_from_row(row))
+        return results
+
+    except Exception as e:
+        logger.error(f"Failed to query similar images (batch of {len(queries)}): {e}")
+        return [[] for _ in queries]
+
+async def find_similar_images_batch(
+    embeddings,
+    limit: int = 1,
+    include_image: bool = True,
+    ef_search: int = None
+):
+    """
+    Nearest-neighbour search for several query faces in one round-trip.
+    The query vectors are sent as a single vector[] parameter and each
+    one drives its own HNSW top-k through a LATERAL join, so N queries
+    cost one parse/plan and one network trip instead of N.
+    Returns one result list per input embedding, in input order, each
+    shaped like find_similar_image's.
+    """
+    return await _search_batch(
+        embeddings, limit, include_image,
+        order_by=_index_distance("q.v"),
+        setting="hnsw.ef_search",
+        setting_value=ef_search or _default_ef_search(limit)
+    )
+
+# IVFFlat index 'idx_fc_ivf' for bulk / analytics searches (e.g. matching
+# a whole batch of faces offline). Cheaper to build and smaller than HNSW,
+# at lower recall per probe. Built on request by migrate_db.py once the
+# table is loaded, since IVFFlat clusters are fixed at build time.
+IVFFLAT_PROBES = 20
+
+async def find_similar_images_ivf(
+    embeddings,
+    limit: int = 1,
+    include_image: bool = False,
+    probes: int = IVFFLAT_PROBES
+):
+    """
+    Batch search like find_similar_images_batch, but ranked through the
+    IVFFlat index (idx_fc_ivf) instead of HNSW. Meant for bulk, recall-
+    tolerant workloads; the interactive API stays on HNSW. `probes`
+    (ivfflat.probes) trades speed for recall.
+    """
+    return await _search_batch(
+        embeddings, limit, include_image,
+        order_by="embedding <=> q.v",
+        setting="ivfflat.probes",
+        setting_value=probes
+    )
+
+async def get_image_base64(filename: str):
+    """
+    Return the stored base64 image for 'filename', or None if there is
+    no such row. Used to hydrate matches returned without their image.
+    """
+    try:
+        async with get_connection() as conn:
+            return await conn.fetchval(
+                "SELECT image_base64 FROM facecrime_image WHERE filename = $1",
+                filename
+            )
+    except Exception as e:
+        logger.error(f"Failed to fetch image for {filename}: {e}")
+        return None